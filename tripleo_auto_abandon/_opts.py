@@ -16,7 +16,11 @@ import copy
 
 from oslo_config import cfg
 
-opts = [
+gerrit_opts = [
+    cfg.StrOpt('gerrit_url',
+               default='https://review.openstack.org',
+               help='Base URL of the Gerrit instance.',
+               ),
     cfg.StrOpt('gerrit_user',
                help='Username for connecting to Gerrit.',
                ),
@@ -31,12 +35,96 @@ opts = [
                help=('Reviewstats project file listing the projects that the '
                      'tool should be run against.'),
                ),
+    cfg.IntOpt('max_concurrency',
+               default=4,
+               help=('Maximum number of requests that will be made to a '
+                     'single Gerrit instance at the same time. The number '
+                     'actually used is adjusted within this limit based on '
+                     'how quickly and reliably Gerrit is responding.'),
+               ),
+    cfg.FloatOpt('request_timeout',
+                 default=30.0,
+                 help='Timeout in seconds for a single request to Gerrit.',
+                 ),
+    cfg.IntOpt('max_retries',
+               default=5,
+               help=('Number of times a request that fails to connect, or '
+                     'gets a 429 or 503 response, is retried. Other '
+                     'failures, including connections dropped after the '
+                     'request was sent, are not retried, as Gerrit may '
+                     'already have applied the request.'),
+               ),
+    cfg.FloatOpt('retry_backoff',
+                 default=1.0,
+                 help=('Base delay in seconds between retries. The delay '
+                       'doubles with each retry and is randomly jittered.'),
+                 ),
+    cfg.FloatOpt('max_retry_backoff',
+                 default=60.0,
+                 help='Maximum delay in seconds between retries.',
+                 ),
+    cfg.FloatOpt('target_latency',
+                 default=5.0,
+                 help=('Requests taking longer than this many seconds cause '
+                       'the number of concurrent requests to be reduced.'),
+                 ),
+    cfg.IntOpt('circuit_failure_threshold',
+               default=5,
+               help=('Number of consecutive failed requests after which '
+                     'requests to Gerrit are paused.'),
+               ),
+    cfg.FloatOpt('circuit_reset_timeout',
+                 default=60.0,
+                 help=('Number of seconds requests to Gerrit are paused for '
+                       'before a single request is allowed through to check '
+                       'whether it has recovered.'),
+                 ),
+    cfg.IntOpt('circuit_max_pauses',
+               default=3,
+               help=('Number of times requests to Gerrit are paused without '
+                     'it recovering before all further requests to it fail '
+                     'immediately.'),
+               ),
+]
+
+opts = [
+    cfg.ListOpt('gerrits',
+                default=[],
+                help=('Names of the Gerrit instances the tool should be run '
+                      'against. Each name refers to a config section of the '
+                      'same name, which may contain any of gerrit_url, '
+                      'gerrit_user, ssh_key_file, http_password, '
+                      'project_file, max_concurrency and the request options '
+                      'below. Options not set in the section are taken from '
+                      'DEFAULT. If empty, a single Gerrit instance is '
+                      'configured from DEFAULT.'),
+                ),
+] + gerrit_opts + [
     cfg.BoolOpt('dryrun',
                 default=True,
                 help=('When set to True, no changes will actually be '
                       'abandoned.'),
                 ),
+    cfg.StrOpt('index_file',
+               default='auto-abandon.sqlite',
+               help=('SQLite database in which the state of open changes is '
+                     'recorded on every run, for use by the query command. '
+                     'Set to an empty value to disable.'),
+               ),
 ]
 
+
+def gerrit_group_opts():
+    """Options for a per-Gerrit config section
+
+    These are the same as the Gerrit options in DEFAULT, but without
+    defaults so that unset values can fall back to DEFAULT.
+    """
+    group_opts = copy.deepcopy(gerrit_opts)
+    for opt in group_opts:
+        opt.default = None
+    return group_opts
+
+
 def list_opts():
     return [(None, copy.deepcopy(opts))]
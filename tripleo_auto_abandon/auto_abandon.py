@@ -16,13 +16,15 @@
 import calendar
 import datetime
 import json
+from multiprocessing import pool
+import time
 
 from oslo_config import cfg
-import requests
-from requests import auth
 from reviewstats import utils
 
 from tripleo_auto_abandon import _opts
+from tripleo_auto_abandon import client
+from tripleo_auto_abandon import index
 
 WARN_MSG = ('TripleO Review Cleanup Bot\n\n'
             'This change has had unaddressed negative feedback for a '
@@ -49,6 +51,45 @@ def load_config():
     CONF(['--config-file', 'auto-abandon.conf'])
 
 
+def load_gerrits():
+    """Create a client.Gerrit for each configured Gerrit instance
+
+    Options not set in a Gerrit's own config section fall back to the value
+    in DEFAULT.  If no Gerrits are listed, a single one is created from
+    DEFAULT alone.
+    """
+    gerrits = []
+    for name in CONF.gerrits or [None]:
+        if name is None:
+            group = CONF
+        else:
+            CONF.register_opts(_opts.gerrit_group_opts(), group=name)
+            group = CONF[name]
+
+        def value(opt):
+            result = getattr(group, opt)
+            if result is None:
+                result = getattr(CONF, opt)
+            return result
+
+        gerrits.append(client.Gerrit(name or 'default',
+                                     value('gerrit_url'),
+                                     value('gerrit_user'),
+                                     value('ssh_key_file'),
+                                     value('http_password'),
+                                     value('project_file'),
+                                     value('max_concurrency'),
+                                     value('request_timeout'),
+                                     value('max_retries'),
+                                     value('retry_backoff'),
+                                     value('max_retry_backoff'),
+                                     value('target_latency'),
+                                     value('circuit_failure_threshold'),
+                                     value('circuit_reset_timeout'),
+                                     value('circuit_max_pauses')))
+    return gerrits
+
+
 def _dry_run_msg(url, data):
     return ("DRY RUN: POST %s DATA: %s" %(url, data))
 
@@ -62,55 +103,69 @@ def purty_print(msg):
     print "%s: %s " %(time_stamp, msg)
 
 
-def get_changes():
+def get_changes(gerrit):
     #with open('changes.json') as f:
     #    return json.loads(f.read())
-    projects = utils.get_projects_info(CONF.project_file)
+    projects = utils.get_projects_info(gerrit.project_file)
 
-    return utils.get_changes(projects, CONF.gerrit_user, CONF.ssh_key_file,
-                             only_open=True)
+    return utils.get_changes(projects, gerrit.user, gerrit.ssh_key_file,
+                             only_open=True, server=gerrit.host)
 
 
-def warn(change_id, revision_id):
-    url = ('https://review.openstack.org/a/changes/%s/revisions/%s/review' %
-           (change_id, revision_id))
+def warn(gerrit, change_id, revision_id):
+    path = 'changes/%s/revisions/%s/review' % (change_id, revision_id)
     data = {'message': WARN_MSG}
     if CONF.dryrun:
-        response = _dry_run_msg(url, data)
+        response = _dry_run_msg(gerrit.api_url(path), data)
+        gerrit.count('would_warn')
     else:
-        response = requests.post(url, json=data,
-                                 auth=auth.HTTPDigestAuth(CONF.gerrit_user,
-                                                          CONF.http_password))
+        try:
+            response = gerrit.post(path, data)
+        except client.GerritError as e:
+            gerrit.count('failed')
+            purty_print('Failed to warn %s: %s' % (change_id, e))
+            return
+        gerrit.count('warned')
     purty_print(response)
 
 
-def abandon(change_id):
-    url = ('https://review.openstack.org/a/changes/%s/abandon' %
-           change_id)
+def abandon(gerrit, change_id):
+    """Abandon a change
+
+    Returns True if the change was actually abandoned, which is never the
+    case in dry run mode.
+    """
+    path = 'changes/%s/abandon' % change_id
     data = {'message': AB_MSG}
     if CONF.dryrun:
-        response = _dry_run_msg(url, data)
+        response = _dry_run_msg(gerrit.api_url(path), data)
+        gerrit.count('would_abandon')
     else:
-        response = requests.post(url, json=data,
-                                 auth=auth.HTTPDigestAuth(CONF.gerrit_user,
-                                                          CONF.http_password))
+        try:
+            response = gerrit.post(path, data)
+        except client.GerritError as e:
+            gerrit.count('failed')
+            purty_print('Failed to abandon %s: %s' % (change_id, e))
+            return False
+        gerrit.count('abandoned')
     purty_print(response)
+    return not CONF.dryrun
 
 
-def days_since_negative_feedback(approvals, now_ts):
-    """Check for reviews with unaddressed negative feedback
+def negative_feedback_timestamp(approvals):
+    """Find the time of the oldest unaddressed negative feedback
 
     This is defined as any negative review that was not followed up by a new
     patch set or a non-negative comment (to allow for committers to respond to
     feedback). A Failed CI pass is also considered unaddressed negative
     feedback, regardless of any subsequent reviews.
 
-    Returns 0 if there is no unaddressed negative feedback.  Otherwise returns
-    the number of days since the unaddressed negative feedback was posted.
+    Returns None if there is no unaddressed negative feedback.  Otherwise
+    returns the timestamp, in seconds, at which the oldest unaddressed
+    negative feedback was posted.
 
     :param approvals: list of gerrit approvals for the latest patch set of
         the change.
-    :param now_ts: The current timestamp, in seconds.
     """
     negative_feedback = False
     failed_ci = False
@@ -127,7 +182,7 @@ def days_since_negative_feedback(approvals, now_ts):
             else:
                 negative_feedback = None
     if not negative_feedback and not failed_ci:
-        return 0
+        return None
     if negative_feedback and failed_ci:
         oldest_negative = min(negative_feedback['grantedOn'],
                             failed_ci['grantedOn'])
@@ -135,18 +190,53 @@ def days_since_negative_feedback(approvals, now_ts):
         oldest_negative = (negative_feedback['grantedOn']
                             if negative_feedback
                             else failed_ci['grantedOn'])
-    age = now_ts - oldest_negative
+    return oldest_negative
+
+
+def days_since_negative_feedback(approvals, now_ts):
+    """Check for reviews with unaddressed negative feedback
+
+    See negative_feedback_timestamp for what counts as unaddressed negative
+    feedback.
+
+    Returns 0 if there is no unaddressed negative feedback.  Otherwise returns
+    the number of days since the unaddressed negative feedback was posted.
+
+    :param approvals: list of gerrit approvals for the latest patch set of
+        the change.
+    :param now_ts: The current timestamp, in seconds.
+    """
+    return days_since(negative_feedback_timestamp(approvals), now_ts)
+
+
+def days_since(timestamp, now_ts):
+    """Whole days between timestamp and now_ts, or 0 if timestamp is None"""
+    if timestamp is None:
+        return 0
+    age = now_ts - timestamp
     # The timestamps are in seconds
     days = age / (60 * 60 * 24)
     return days
 
 
-def process_changes(changes):
+def process_changes(gerrit, changes):
+    """Abandon changes with long-standing unaddressed negative feedback
+
+    Returns an index.ChangeIndex record for every change that is still
+    open afterwards.  The negative_since field of a record is only set if
+    the change is a candidate for abandonment.
+    """
+    # Abandons are sent from a pool sized to the Gerrit's concurrency limit.
+    workers = pool.ThreadPool(gerrit.max_concurrency)
+    pending = []
+    records = []
     now = datetime.datetime.utcnow()
-    # NOTE(bnemec): This is only used in days_since_negative_feedback,
+    # NOTE(bnemec): This is only used in days_since,
     # but there's no sense recalculating it every iteration through the loop.
     now_ts = calendar.timegm(now.timetuple())
     for change in changes:
+        record = index.change_record(change)
+        records.append(record)
         if utils.is_workinprogress(change):
             continue
         # NOTE(bnemec): I think Gerrit already returns patch sets sorted, but
@@ -163,11 +253,12 @@ def process_changes(changes):
         # since the last vote.  Let's not abandon it again.
         if change['lastUpdated'] > approvals[-1]['grantedOn']:
             continue
-        days = days_since_negative_feedback(approvals, now_ts)
+        record['negative_since'] = negative_feedback_timestamp(approvals)
+        days = days_since(record['negative_since'], now_ts)
 
 
 
-        #warn(change['id'], last_patchset['revision'])
+        #warn(gerrit, change['id'], last_patchset['revision'])
 
 
 
@@ -175,25 +266,70 @@ def process_changes(changes):
             purty_print('Abandoning %s - %s' %
                         (change['url'],
                          change['commitMessage'].split('\n')[0]))
-            abandon(change['id'])
+            pending.append((record,
+                            workers.apply_async(abandon,
+                                                (gerrit, change['id']))))
         # NOTE(bnemec): This probably complicates things too much.  We'd have
         # to check that we haven't already commented on the patch set, and
         # I'm not sure the return on investment is worth it.
         #elif days > 24:
             #print 'Warning %s' % change['url']
-            #warn(change['id'], last_patchset['revision'])
+            #warn(gerrit, change['id'], last_patchset['revision'])
 
+    workers.close()
+    workers.join()
+    # Re-raise any errors from the workers, and drop the changes that are
+    # now closed.
+    for record, result in pending:
+        if result.get():
+            records.remove(record)
+    return records
 
-def main():
-    load_config()
-    changes = get_changes()
+
+def run(gerrit, change_index=None):
+    start = time.time()
+    changes = get_changes(gerrit)
+    gerrit.count('fetch_seconds', round(time.time() - start, 2))
+    gerrit.count('changes', len(changes))
 
     #with open('changes.json', 'w') as f:
     #    f.write(json.dumps(changes))
     #changes = [c for c in changes if c['id'] == 'Icffa80719841291de3a05f6439925a8d068d36eb']
     #print changes
 
-    process_changes(changes)
+    records = process_changes(gerrit, changes)
+    if change_index is not None:
+        change_index.update(gerrit.name, records)
+    gerrit.count('total_seconds', round(time.time() - start, 2))
+
+
+def report_stats(gerrit):
+    stats = ', '.join('%s=%s' % (k, v)
+                      for k, v in sorted(gerrit.stats.items()))
+    purty_print('Stats for %s (%s): %s' % (gerrit.name, gerrit.url, stats))
+
+
+def main():
+    load_config()
+    gerrits = load_gerrits()
+    change_index = None
+    if CONF.index_file:
+        change_index = index.ChangeIndex(CONF.index_file)
+
+    # Each Gerrit is fetched and processed in its own thread so a slow
+    # instance doesn't hold up the others.
+    workers = pool.ThreadPool(len(gerrits))
+    results = [workers.apply_async(run, (gerrit, change_index))
+               for gerrit in gerrits]
+    workers.close()
+    workers.join()
+    if change_index is not None:
+        change_index.close()
+
+    for gerrit in gerrits:
+        report_stats(gerrit)
+    for result in results:
+        result.get()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,289 @@
+# Copyright 2015 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import random
+import threading
+import time
+
+import requests
+from requests import adapters
+from requests import auth
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+try:
+    from urllib import parse as urlparse
+except ImportError:
+    import urlparse
+
+
+class GerritError(Exception):
+    pass
+
+
+class AdaptiveLimiter(object):
+    """Concurrency limit that adapts to how well Gerrit is coping
+
+    The limit is managed AIMD-style: every healthy response raises it by
+    1/limit, so it grows by roughly one per round of requests, and every
+    error or response slower than target_latency halves it.  The limit
+    never goes below one or above max_limit.
+    """
+    def __init__(self, max_limit, target_latency):
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.limit = 1.0
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def cancel(self):
+        """Give up a slot without a request having been made"""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def release(self, latency, healthy):
+        with self._cond:
+            self.in_flight -= 1
+            if healthy and latency <= self.target_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(1.0, self.limit / 2)
+            self._cond.notify_all()
+
+
+class CircuitBreaker(object):
+    """Pause requests to a Gerrit that appears to be unhealthy
+
+    After failure_threshold consecutive failures the circuit opens and
+    wait() blocks all callers for reset_timeout seconds.  After that a
+    single caller is let through as a trial; if it succeeds the circuit
+    closes again, otherwise it reopens for another reset_timeout.
+
+    If the circuit opens more than max_pauses times without a successful
+    request in between, Gerrit is considered down and wait() raises
+    GerritError immediately from then on, rather than pausing forever.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout, max_pauses):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_pauses = max_pauses
+        self.state = self.CLOSED
+        self.failures = 0
+        self.pauses = 0
+        self._opened_at = None
+        self._cond = threading.Condition()
+
+    def wait(self):
+        with self._cond:
+            while self.state != self.CLOSED:
+                if self.state == self.OPEN and self.pauses > self.max_pauses:
+                    raise GerritError('Giving up after Gerrit failed to '
+                                      'recover from %d pauses' %
+                                      self.max_pauses)
+                if self.state == self.OPEN:
+                    remaining = (self._opened_at + self.reset_timeout -
+                                 time.time())
+                    if remaining <= 0:
+                        self.state = self.HALF_OPEN
+                        return
+                    self._cond.wait(remaining)
+                else:
+                    # Another caller is making the trial request
+                    self._cond.wait()
+
+    def success(self):
+        with self._cond:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.pauses = 0
+            self._cond.notify_all()
+
+    def failure(self):
+        with self._cond:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self.failure_threshold)):
+                self.state = self.OPEN
+                self.pauses += 1
+                self._opened_at = time.time()
+            self._cond.notify_all()
+
+
+# Responses for which Gerrit is known not to have acted on the request.
+RETRY_STATUSES = (429, 503)
+
+
+def _healthy(response):
+    return response.status_code != 429 and response.status_code < 500
+
+
+def _retryable(response):
+    return response.status_code in RETRY_STATUSES
+
+
+def _retryable_error(error):
+    # Only errors raised before the request was sent are safe to retry.
+    # Anything later, such as a read timeout or the connection being reset
+    # while waiting for the response, may come after Gerrit applied it.
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', None)
+        return isinstance(reason, urllib3_exceptions.NewConnectionError)
+    return False
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 0
+
+
+class Gerrit(object):
+    """A single Gerrit instance and the state used to talk to it
+
+    Each instance gets its own HTTP session, so connections are pooled per
+    host and never shared between Gerrits.  The pool is sized to
+    max_concurrency, which is also the number of requests callers should
+    have in flight against this Gerrit at once.
+
+    Requests made through post() are limited by an AdaptiveLimiter and a
+    CircuitBreaker, and are retried with jittered exponential backoff if
+    they fail in a way that means Gerrit can't have applied them.
+    """
+    def __init__(self, name, url, user, ssh_key_file, http_password,
+                 project_file, max_concurrency, request_timeout=30.0,
+                 max_retries=5, retry_backoff=1.0, max_retry_backoff=60.0,
+                 target_latency=5.0, circuit_failure_threshold=5,
+                 circuit_reset_timeout=60.0, circuit_max_pauses=3):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.user = user
+        self.ssh_key_file = ssh_key_file
+        self.project_file = project_file
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+
+        self.session = requests.Session()
+        self.session.auth = auth.HTTPDigestAuth(user, http_password)
+        self.session.mount(self.url,
+                           adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=max_concurrency))
+
+        self.limiter = AdaptiveLimiter(max_concurrency, target_latency)
+        self.breaker = CircuitBreaker(circuit_failure_threshold,
+                                      circuit_reset_timeout,
+                                      circuit_max_pauses)
+
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def host(self):
+        return urlparse.urlparse(self.url).hostname
+
+    def api_url(self, path):
+        return '%s/a/%s' % (self.url, path)
+
+    def _backoff(self, attempt, response):
+        delay = min(self.max_retry_backoff, self.retry_backoff * 2 ** attempt)
+        delay = random.uniform(0, delay)
+        if response is not None:
+            delay = max(delay, min(self.max_retry_backoff,
+                                   _retry_after(response)))
+        return delay
+
+    def _send(self, url, data):
+        """Make a single request, updating the limiter and circuit breaker
+
+        Returns a (response, error) tuple, only one of which is set.
+        """
+        self.limiter.acquire()
+        # The breaker is checked once a slot is held, so requests that were
+        # queued on the limiter when the circuit opened wait as well.
+        try:
+            self.breaker.wait()
+        except GerritError:
+            self.limiter.cancel()
+            raise
+        start = time.time()
+        response = error = None
+        try:
+            response = self.session.post(url, json=data,
+                                         timeout=self.request_timeout)
+        except requests.RequestException as e:
+            error = e
+        finally:
+            healthy = response is not None and _healthy(response)
+            self.limiter.release(time.time() - start, healthy)
+            if healthy:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+                self.count('request_failures')
+        return response, error
+
+    def post(self, path, data):
+        """POST data to the Gerrit REST API
+
+        POSTs aren't idempotent, so retrying one that Gerrit already
+        applied would post a duplicate review comment, or fail with a 409
+        for an abandon.  Only failures where the request can't have been
+        applied are retried: failures to connect (including connect
+        timeouts), 429 and 503.  Read timeouts, connections dropped after
+        the request was sent and other 5xx responses are not retried.
+
+        Raises GerritError if the request is rejected, still failing
+        after max_retries retries, or the circuit breaker has given up on
+        this Gerrit.
+        """
+        url = self.api_url(path)
+        for attempt in range(self.max_retries + 1):
+            response, error = self._send(url, data)
+            if error is not None:
+                if not _retryable_error(error):
+                    break
+            elif not _retryable(response):
+                break
+            if attempt < self.max_retries:
+                self.count('retries')
+                time.sleep(self._backoff(attempt, response))
+        if error is not None:
+            raise GerritError('POST %s failed: %s' % (url, error))
+        if response.status_code >= 300:
+            raise GerritError('POST %s failed: %s %s' %
+                              (url, response.status_code, response.text))
+        return response
+
+    def count(self, stat, value=1):
+        # Actions against a Gerrit run in a thread pool, so the stats need
+        # to be protected.
+        with self._stats_lock:
+            self.stats[stat] += value
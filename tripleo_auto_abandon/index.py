@@ -0,0 +1,142 @@
+# Copyright 2015 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sqlite3
+import threading
+
+ONE_DAY = 60 * 60 * 24
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS changes (
+           gerrit TEXT NOT NULL,
+           number TEXT NOT NULL,
+           change_id TEXT,
+           project TEXT,
+           owner TEXT,
+           revision TEXT,
+           url TEXT,
+           subject TEXT,
+           last_updated INTEGER,
+           negative_since INTEGER,
+           PRIMARY KEY (gerrit, number)
+       )''',
+    '''CREATE INDEX IF NOT EXISTS changes_negative_since
+           ON changes (negative_since)''',
+    '''CREATE INDEX IF NOT EXISTS changes_owner
+           ON changes (owner, negative_since)''',
+    # Changes seen by the update in progress, used to prune the rest
+    '''CREATE TEMP TABLE IF NOT EXISTS seen (
+           number TEXT PRIMARY KEY
+       )''',
+]
+
+
+def change_record(change):
+    """Create an index record from a change returned by Gerrit
+
+    negative_since is left unset, it's up to the caller to fill it in if
+    the change is a candidate for abandonment.
+    """
+    last_patchset = max(change['patchSets'], key=lambda a: int(a['number']))
+    owner = change.get('owner', {})
+    return {'number': change.get('number'),
+            'change_id': change['id'],
+            'project': change.get('project'),
+            'owner': (owner.get('username') or owner.get('email') or
+                      owner.get('name')),
+            'revision': last_patchset['revision'],
+            'url': change.get('url'),
+            'subject': change.get('subject'),
+            'last_updated': change['lastUpdated'],
+            'negative_since': None,
+            }
+
+
+class ChangeIndex(object):
+    """Local record of the open changes seen on the last run
+
+    This allows questions about stale changes to be answered without
+    fetching everything from Gerrit again.
+    """
+    def __init__(self, path):
+        # Each Gerrit is processed in its own thread, so the connection is
+        # shared and access to it serialized.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+
+    def close(self):
+        self._conn.close()
+
+    def update(self, gerrit, records):
+        """Replace the indexed changes for a Gerrit
+
+        records should cover every open change on the Gerrit.  Changes
+        indexed previously that are not included have been closed since,
+        and are removed.
+        """
+        rows = []
+        for record in records:
+            row = dict(record)
+            row['gerrit'] = gerrit
+            rows.append(row)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO changes (gerrit, number, change_id, '
+                'project, owner, revision, url, subject, last_updated, '
+                'negative_since) VALUES (:gerrit, :number, :change_id, '
+                ':project, :owner, :revision, :url, :subject, '
+                ':last_updated, :negative_since)',
+                rows)
+            self._conn.execute('DELETE FROM seen')
+            self._conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)',
+                                   [(r['number'],) for r in rows])
+            self._conn.execute(
+                'DELETE FROM changes WHERE gerrit = ? AND '
+                'number NOT IN (SELECT number FROM seen)',
+                (gerrit,))
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def near_abandonment(self, now_ts, abandon_days, within_days):
+        """Changes that will be abandoned within the given number of days
+
+        Changes that are already overdue are included.  Results are ordered
+        by how soon the change will be abandoned.
+        """
+        # Changes are abandoned once more than abandon_days whole days have
+        # passed, i.e. at abandon_days + 1.
+        cutoff = now_ts - (abandon_days + 1 - within_days) * ONE_DAY
+        return self._query(
+            'SELECT * FROM changes WHERE negative_since <= ? '
+            'ORDER BY negative_since',
+            (cutoff,))
+
+    def stale_owners(self, now_ts, min_days=0, limit=10):
+        """Owners with the most changes that have negative feedback
+
+        Only negative feedback at least min_days old is counted.  Returns
+        rows of owner and count, most stale changes first.
+        """
+        cutoff = now_ts - min_days * ONE_DAY
+        return self._query(
+            'SELECT owner, COUNT(*) AS count FROM changes '
+            'WHERE negative_since <= ? GROUP BY owner '
+            'ORDER BY count DESC, owner LIMIT ?',
+            (cutoff, limit))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright 2015 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Report on stale changes using the index from the last auto-abandon run
+
+This only reads the local index, so it doesn't touch Gerrit at all.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from tripleo_auto_abandon import auto_abandon
+from tripleo_auto_abandon import index
+
+
+def near_abandonment(change_index, now_ts, days):
+    for change in change_index.near_abandonment(now_ts,
+                                                auto_abandon.ABANDON_DAYS,
+                                                days):
+        age = (now_ts - change['negative_since']) / index.ONE_DAY
+        remaining = max(0, auto_abandon.ABANDON_DAYS + 1 - age)
+        print '%3d days left: %s %s - %s (%s)' % (remaining, change['url'],
+                                                  change['project'],
+                                                  change['subject'],
+                                                  change['owner'])
+
+
+def stale_owners(change_index, now_ts, min_days, limit):
+    for row in change_index.stale_owners(now_ts, min_days, limit):
+        print '%5d %s' % (row['count'], row['owner'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    near = subparsers.add_parser(
+        'near-abandonment',
+        help='List changes that will be abandoned within a number of days.')
+    near.add_argument('--days', type=int, default=7,
+                      help='Number of days to look ahead. Default: 7')
+    owners = subparsers.add_parser(
+        'owners',
+        help='List the owners with the most changes with negative feedback.')
+    owners.add_argument('--min-days', type=int, default=0,
+                        help=('Only count negative feedback at least this '
+                              'many days old. Default: 0'))
+    owners.add_argument('--limit', type=int, default=10,
+                        help='Number of owners to list. Default: 10')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    auto_abandon.load_config()
+    if not auto_abandon.CONF.index_file:
+        sys.exit('index_file must be set to use the query command')
+    # Opening the index would create an empty one, which would make a wrong
+    # path look like there are no stale changes.
+    if not os.path.exists(auto_abandon.CONF.index_file):
+        sys.exit('Index %s does not exist. It is created by running '
+                 'auto_abandon.' % auto_abandon.CONF.index_file)
+    change_index = index.ChangeIndex(auto_abandon.CONF.index_file)
+    now_ts = int(time.time())
+    try:
+        if args.command == 'near-abandonment':
+            near_abandonment(change_index, now_ts, args.days)
+        else:
+            stale_owners(change_index, now_ts, args.min_days, args.limit)
+    finally:
+        change_index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_client
+----------------------------------
+
+Tests for `tripleo_auto_abandon.client` module.
+
+Requests are made against a local stand-in for Gerrit that can be told to
+fail in various ways.
+"""
+import socket
+import threading
+import time
+
+try:
+    from http import server as http_server
+    import socketserver
+except ImportError:
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+
+from tripleo_auto_abandon import client
+from tripleo_auto_abandon.tests import base
+
+
+class FaultInjectingHandler(http_server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.server.requests.append(self.path)
+        if self.server.faults:
+            fault = self.server.faults.pop(0)
+        else:
+            fault = 200
+        if fault == 'drop':
+            # Close the connection without sending a response
+            self.close_connection = True
+            return
+        if fault == 'badchunk':
+            # Promise a chunked body, then send garbage instead
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'not a chunk\r\n')
+            self.close_connection = True
+            return
+        if fault == 'slow':
+            time.sleep(self.server.slow_delay)
+            fault = 200
+        body = b')]}\'\n{}'
+        self.send_response(fault)
+        if fault == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGerrit(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        http_server.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                        FaultInjectingHandler)
+        self.faults = []
+        self.requests = []
+        self.slow_delay = 0.5
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow responses are expected
+        pass
+
+
+class TestGerritPost(base.TestCase):
+    def setUp(self):
+        super(TestGerritPost, self).setUp()
+        self.server = FakeGerrit()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _get_gerrit(self, **kwargs):
+        params = {'request_timeout': 0.2,
+                  'max_retries': 3,
+                  'retry_backoff': 0.01,
+                  'max_retry_backoff': 0.05,
+                  }
+        params.update(kwargs)
+        return client.Gerrit('fake', self.server.url, 'foo', None, 'bar',
+                             None, 4, **params)
+
+    def test_success(self):
+        gerrit = self._get_gerrit()
+        response = gerrit.post('changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['/a/changes/123/abandon'], self.server.requests)
+        self.assertEqual(0, gerrit.stats['retries'])
+
+    def _test_retry(self, fault):
+        self.server.faults = [fault, fault]
+        gerrit = self._get_gerrit()
+        response = gerrit.post('changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(2, gerrit.stats['retries'])
+        self.assertEqual(2, gerrit.stats['request_failures'])
+
+    def test_retry_server_error(self):
+        self._test_retry(503)
+
+    def test_retry_throttled(self):
+        self._test_retry(429)
+
+    def test_retry_connection_refused(self):
+        # Find a port with nothing listening on it
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        gerrit = self._get_gerrit()
+        gerrit.url = 'http://127.0.0.1:%d' % port
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(3, gerrit.stats['retries'])
+        self.assertEqual(4, gerrit.stats['request_failures'])
+
+    def _test_no_retry(self, fault):
+        self.server.faults = [fault]
+        gerrit = self._get_gerrit()
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(0, gerrit.stats['retries'])
+        self.assertEqual(1, gerrit.stats['request_failures'])
+
+    def test_no_retry_dropped_connection(self):
+        self._test_no_retry('drop')
+
+    def test_no_retry_read_timeout(self):
+        self._test_no_retry('slow')
+
+    def test_no_retry_internal_error(self):
+        self._test_no_retry(500)
+
+    def test_no_retry_gateway_timeout(self):
+        self._test_no_retry(504)
+
+    def test_retries_exhausted(self):
+        self.server.faults = [503] * 4
+        gerrit = self._get_gerrit()
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(3, gerrit.stats['retries'])
+
+    def test_no_retry_bad_response(self):
+        self._test_no_retry('badchunk')
+
+    def test_no_retry_client_error(self):
+        self.server.faults = [409]
+        gerrit = self._get_gerrit()
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(0, gerrit.stats['request_failures'])
+
+    def test_circuit_breaker_pauses(self):
+        self.server.faults = [503, 503]
+        gerrit = self._get_gerrit(circuit_failure_threshold=2,
+                                  circuit_reset_timeout=0.3)
+        start = time.time()
+        response = gerrit.post('changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(200, response.status_code)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(client.CircuitBreaker.CLOSED, gerrit.breaker.state)
+
+    def test_circuit_breaker_gives_up(self):
+        self.server.faults = [503] * 100
+        gerrit = self._get_gerrit(max_retries=10,
+                                  circuit_failure_threshold=2,
+                                  circuit_reset_timeout=0.1,
+                                  circuit_max_pauses=1)
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/123/abandon', {'message': 'foo'})
+        requests_made = len(self.server.requests)
+        # Once the breaker has given up, requests fail without waiting or
+        # reaching Gerrit.
+        start = time.time()
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/456/abandon', {'message': 'foo'})
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(requests_made, len(self.server.requests))
+
+    def test_circuit_breaker_pauses_queued_requests(self):
+        gerrit = self._get_gerrit(circuit_failure_threshold=1,
+                                  circuit_reset_timeout=0.3)
+        # Hold the only limiter slot so the next request queues on it
+        gerrit.limiter.acquire()
+        thread = threading.Thread(target=gerrit.post,
+                                  args=('changes/123/abandon',
+                                        {'message': 'foo'}))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.05)
+        gerrit.breaker.failure()
+        gerrit.limiter.cancel()
+        time.sleep(0.1)
+        self.assertEqual([], self.server.requests)
+        thread.join(5)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_circuit_breaker_gives_up_releases_slot(self):
+        gerrit = self._get_gerrit(circuit_failure_threshold=1,
+                                  circuit_max_pauses=0)
+        gerrit.breaker.failure()
+        self.assertRaises(client.GerritError, gerrit.post,
+                          'changes/123/abandon', {'message': 'foo'})
+        self.assertEqual(0, gerrit.limiter.in_flight)
+
+    def test_limiter_reduced_on_errors(self):
+        gerrit = self._get_gerrit()
+        gerrit.limiter.limit = 4.0
+        self.server.faults = [503]
+        gerrit.post('changes/123/abandon', {'message': 'foo'})
+        self.assertLess(gerrit.limiter.limit, 4.0)
+        self.assertEqual(0, gerrit.limiter.in_flight)
+
+
+class TestAdaptiveLimiter(base.TestCase):
+    def setUp(self):
+        super(TestAdaptiveLimiter, self).setUp()
+        self.limiter = client.AdaptiveLimiter(4, 1.0)
+
+    def test_additive_increase(self):
+        for i in range(10):
+            self.limiter.acquire()
+            self.limiter.release(0.1, True)
+        self.assertEqual(4, self.limiter.limit)
+        self.assertEqual(0, self.limiter.in_flight)
+
+    def test_multiplicative_decrease(self):
+        self.limiter.limit = 4.0
+        self.limiter.acquire()
+        self.limiter.release(0.1, False)
+        self.assertEqual(2.0, self.limiter.limit)
+        self.limiter.acquire()
+        self.limiter.release(0.1, False)
+        self.limiter.acquire()
+        self.limiter.release(0.1, False)
+        self.assertEqual(1.0, self.limiter.limit)
+
+    def test_slow_response(self):
+        self.limiter.limit = 4.0
+        self.limiter.acquire()
+        self.limiter.release(2.0, True)
+        self.assertEqual(2.0, self.limiter.limit)
+
+    def test_acquire_blocks_at_limit(self):
+        self.limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            self.limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        self.limiter.release(0.1, True)
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
+
+class TestCircuitBreaker(base.TestCase):
+    def test_opens_after_threshold(self):
+        breaker = client.CircuitBreaker(2, 60, 3)
+        breaker.failure()
+        self.assertEqual(breaker.CLOSED, breaker.state)
+        breaker.failure()
+        self.assertEqual(breaker.OPEN, breaker.state)
+
+    def test_success_resets_failures(self):
+        breaker = client.CircuitBreaker(2, 60, 3)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.CLOSED, breaker.state)
+
+    def test_failed_trial_reopens(self):
+        breaker = client.CircuitBreaker(1, 0, 3)
+        breaker.failure()
+        breaker.wait()
+        self.assertEqual(breaker.HALF_OPEN, breaker.state)
+        breaker.failure()
+        self.assertEqual(breaker.OPEN, breaker.state)
+        breaker.wait()
+        breaker.success()
+        self.assertEqual(breaker.CLOSED, breaker.state)
+
+    def test_gives_up_after_max_pauses(self):
+        breaker = client.CircuitBreaker(1, 0, 1)
+        breaker.failure()
+        breaker.wait()
+        breaker.failure()
+        self.assertRaises(client.GerritError, breaker.wait)
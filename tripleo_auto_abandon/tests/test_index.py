@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_index
+----------------------------------
+
+Tests for `tripleo_auto_abandon.index` module.
+"""
+import copy
+import os
+
+import fixtures
+import mock
+from oslo_config import fixture as config_fixture
+
+from tripleo_auto_abandon import index
+from tripleo_auto_abandon import query
+from tripleo_auto_abandon.tests import base
+
+ONE_DAY = 60 * 60 * 24
+NOW_TS = 1000 * ONE_DAY
+ABANDON_DAYS = 31
+
+FAKE_CHANGE = {
+    'patchSets': [
+        {'number': '2', 'revision': 'def'},
+        {'number': '1', 'revision': 'abc'},
+    ],
+    'id': 'fake-id',
+    'number': '1234',
+    'project': 'openstack/fake',
+    'owner': {'name': 'Fake Owner', 'username': 'fake'},
+    'url': 'https://fake-url',
+    'subject': 'Fake commit message',
+    'lastUpdated': 10,
+}
+
+
+def fake_record(number, owner='fake', days_ago=None):
+    change = copy.deepcopy(FAKE_CHANGE)
+    change['number'] = number
+    change['owner'] = {'username': owner}
+    record = index.change_record(change)
+    if days_ago is not None:
+        record['negative_since'] = NOW_TS - days_ago * ONE_DAY
+    return record
+
+
+class TestChangeRecord(base.TestCase):
+    def test_change_record(self):
+        record = index.change_record(FAKE_CHANGE)
+        self.assertEqual({'number': '1234',
+                          'change_id': 'fake-id',
+                          'project': 'openstack/fake',
+                          'owner': 'fake',
+                          'revision': 'def',
+                          'url': 'https://fake-url',
+                          'subject': 'Fake commit message',
+                          'last_updated': 10,
+                          'negative_since': None,
+                          },
+                         record)
+
+    def test_owner_fallback(self):
+        change = copy.deepcopy(FAKE_CHANGE)
+        change['owner'] = {'name': 'Fake Owner', 'email': 'fake@example.com'}
+        self.assertEqual('fake@example.com',
+                         index.change_record(change)['owner'])
+
+
+class TestChangeIndex(base.TestCase):
+    def setUp(self):
+        super(TestChangeIndex, self).setUp()
+        self.index = index.ChangeIndex(':memory:')
+        self.addCleanup(self.index.close)
+
+    def _numbers(self, rows):
+        return [r['number'] for r in rows]
+
+    def test_upsert(self):
+        self.index.update('gerrit', [fake_record('1')])
+        self.index.update('gerrit', [fake_record('1', days_ago=40)])
+        rows = self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 0)
+        self.assertEqual(['1'], self._numbers(rows))
+        self.assertEqual('gerrit', rows[0]['gerrit'])
+
+    def test_prune_closed(self):
+        self.index.update('gerrit', [fake_record('1', days_ago=40),
+                                     fake_record('2', days_ago=40)])
+        self.index.update('other', [fake_record('3', days_ago=40)])
+        self.index.update('gerrit', [fake_record('2', days_ago=40)])
+        rows = self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 0)
+        # Only changes from the Gerrit being updated are pruned
+        self.assertEqual(['2', '3'], sorted(self._numbers(rows)))
+
+    @mock.patch('time.time')
+    def test_prune_clock_change(self, mock_time):
+        # Pruning must not depend on the clock moving forward between runs
+        mock_time.return_value = NOW_TS
+        self.index.update('gerrit', [fake_record('1', days_ago=40),
+                                     fake_record('2', days_ago=40)])
+        mock_time.return_value = NOW_TS - ONE_DAY
+        self.index.update('gerrit', [fake_record('2', days_ago=40)])
+        rows = self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 0)
+        self.assertEqual(['2'], self._numbers(rows))
+
+    def test_prune_all_closed(self):
+        self.index.update('gerrit', [fake_record('1', days_ago=40)])
+        self.index.update('gerrit', [])
+        self.assertEqual([],
+                         self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 0))
+
+    def test_near_abandonment(self):
+        self.index.update('gerrit', [fake_record('1', days_ago=24),
+                                     fake_record('2', days_ago=25),
+                                     fake_record('3', days_ago=40),
+                                     fake_record('4'),
+                                     ])
+        rows = self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 7)
+        self.assertEqual(['3', '2'], self._numbers(rows))
+
+    def test_near_abandonment_boundary(self):
+        # process_changes abandons once more than ABANDON_DAYS whole days
+        # have passed.
+        self.index.update('gerrit', [fake_record('1', days_ago=31),
+                                     fake_record('2', days_ago=32),
+                                     ])
+        rows = self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 0)
+        self.assertEqual(['2'], self._numbers(rows))
+        rows = self.index.near_abandonment(NOW_TS, ABANDON_DAYS, 1)
+        self.assertEqual(['2', '1'], self._numbers(rows))
+
+    def test_stale_owners(self):
+        self.index.update('gerrit', [fake_record('1', 'a', days_ago=1),
+                                     fake_record('2', 'b', days_ago=10),
+                                     fake_record('3', 'b', days_ago=20),
+                                     fake_record('4', 'c'),
+                                     fake_record('5', 'c'),
+                                     ])
+        rows = self.index.stale_owners(NOW_TS)
+        self.assertEqual([('b', 2), ('a', 1)],
+                         [(r['owner'], r['count']) for r in rows])
+        rows = self.index.stale_owners(NOW_TS, min_days=15)
+        self.assertEqual([('b', 1)],
+                         [(r['owner'], r['count']) for r in rows])
+        rows = self.index.stale_owners(NOW_TS, limit=1)
+        self.assertEqual(['b'], [r['owner'] for r in rows])
+
+
+class TestQuery(base.TestCase):
+    def setUp(self):
+        super(TestQuery, self).setUp()
+        self.useFixture(fixtures.MockPatch(
+            'tripleo_auto_abandon.auto_abandon.load_config'))
+        self.useFixture(fixtures.MockPatch('time.time',
+                                           return_value=NOW_TS))
+        self.stdout = self.useFixture(fixtures.StringStream('stdout')).stream
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout', self.stdout))
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'index.sqlite')
+        self.useFixture(config_fixture.Config()).config(index_file=path)
+        change_index = index.ChangeIndex(path)
+        change_index.update('gerrit', [fake_record('1', 'a', days_ago=40),
+                                       fake_record('2', 'b', days_ago=32),
+                                       fake_record('3', 'b', days_ago=31),
+                                       fake_record('4', 'b', days_ago=25),
+                                       fake_record('5', 'c', days_ago=24),
+                                       fake_record('6', 'c'),
+                                       ])
+        change_index.close()
+
+    def _output(self):
+        self.stdout.seek(0)
+        return self.stdout.read().splitlines()
+
+    def test_near_abandonment(self):
+        query.main(['near-abandonment', '--days', '7'])
+        line = ('%3d days left: https://fake-url openstack/fake - '
+                'Fake commit message (%s)')
+        self.assertEqual([line % (0, 'a'),
+                          line % (0, 'b'),
+                          line % (1, 'b'),
+                          line % (7, 'b'),
+                          ],
+                         self._output())
+
+    def test_owners(self):
+        query.main(['owners', '--min-days', '30'])
+        self.assertEqual(['    2 b', '    1 a'], self._output())
+
+    def test_missing_index(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'missing.sqlite')
+        self.useFixture(config_fixture.Config()).config(index_file=path)
+        self.assertRaises(SystemExit, query.main, ['owners'])
+        self.assertFalse(os.path.exists(path))
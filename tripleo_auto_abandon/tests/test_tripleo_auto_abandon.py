@@ -19,11 +19,14 @@ test_tripleo_auto_abandon
 Tests for `tripleo_auto_abandon` module.
 """
 import copy
+import time
 
 import mock
 from oslo_config import fixture as config_fixture
 
+from tripleo_auto_abandon import _opts
 from tripleo_auto_abandon import auto_abandon
+from tripleo_auto_abandon import index
 from tripleo_auto_abandon.tests import base
 
 USER='foo'
@@ -39,74 +42,195 @@ class TestAutoAbandon(base.TestCase):
         self.useFixture(self.conf)
         self.conf.config(gerrit_user=USER, ssh_key_file=KEY_FILE,
                          http_password=HTTP_PASSWORD,
-                         project_file=PROJECT_FILE, dryrun=False)
+                         project_file=PROJECT_FILE, dryrun=False,
+                         index_file='')
+
+    def test_load_gerrits_default(self):
+        gerrits = auto_abandon.load_gerrits()
+        self.assertEqual(1, len(gerrits))
+        gerrit = gerrits[0]
+        self.assertEqual('default', gerrit.name)
+        self.assertEqual('https://review.openstack.org', gerrit.url)
+        self.assertEqual('review.openstack.org', gerrit.host)
+        self.assertEqual(USER, gerrit.user)
+        self.assertEqual(KEY_FILE, gerrit.ssh_key_file)
+        self.assertEqual(PROJECT_FILE, gerrit.project_file)
+        self.assertEqual(4, gerrit.max_concurrency)
+
+    @mock.patch('requests.auth.HTTPDigestAuth')
+    def test_load_gerrits_multiple(self, mock_auth):
+        for name in ('first', 'second'):
+            self.conf.register_opts(_opts.gerrit_group_opts(), group=name)
+        self.conf.config(gerrits=['first', 'second'])
+        self.conf.config(group='first', gerrit_url='https://first.org/',
+                         gerrit_user='first-user', http_password='first-pw',
+                         project_file='/first.json', max_concurrency=2)
+        self.conf.config(group='second', gerrit_url='https://second.org')
+        first, second = auto_abandon.load_gerrits()
+
+        self.assertEqual('first', first.name)
+        self.assertEqual('https://first.org', first.url)
+        self.assertEqual('first-user', first.user)
+        self.assertEqual(KEY_FILE, first.ssh_key_file)
+        self.assertEqual('/first.json', first.project_file)
+        self.assertEqual(2, first.max_concurrency)
+
+        # Unset options fall back to DEFAULT
+        self.assertEqual('second', second.name)
+        self.assertEqual('second.org', second.host)
+        self.assertEqual(USER, second.user)
+        self.assertEqual(PROJECT_FILE, second.project_file)
+        self.assertEqual(4, second.max_concurrency)
+
+        mock_auth.assert_has_calls([mock.call('first-user', 'first-pw'),
+                                    mock.call(USER, HTTP_PASSWORD)])
+        self.assertIsNot(first.session, second.session)
 
     @mock.patch('reviewstats.utils.get_projects_info')
     @mock.patch('reviewstats.utils.get_changes')
     def test_get_changes(self, mock_get_changes, mock_get_projects_info):
         mock_projects = mock.Mock()
         mock_get_projects_info.return_value = mock_projects
-        auto_abandon.get_changes()
+        auto_abandon.get_changes(self._get_gerrit())
         mock_get_projects_info.assert_called_with(PROJECT_FILE)
         mock_get_changes.assert_called_with(mock_projects, USER,
-                                            KEY_FILE, only_open=True)
-
-    @mock.patch('requests.auth.HTTPDigestAuth')
-    @mock.patch('requests.post')
-    def test_warn(self, mock_post, mock_auth):
-        mock_auth_obj = mock.Mock()
-        mock_auth.return_value = mock_auth_obj
-        auto_abandon.warn('123', 'abc')
+                                            KEY_FILE, only_open=True,
+                                            server='review.openstack.org')
+
+    def _get_gerrit(self):
+        gerrit = auto_abandon.load_gerrits()[0]
+        gerrit.session = mock.Mock()
+        gerrit.session.post.return_value.status_code = 200
+        return gerrit
+
+    def test_warn(self):
+        gerrit = self._get_gerrit()
+        auto_abandon.warn(gerrit, '123', 'abc')
         data = {'message': auto_abandon.WARN_MSG}
-        mock_auth.assert_called_with(USER, HTTP_PASSWORD)
-        mock_post.assert_called_with(
+        gerrit.session.post.assert_called_with(
             'https://review.openstack.org/a/changes/123/revisions/abc/review',
             json=data,
-            auth=mock_auth_obj
+            timeout=30.0
             )
+        self.assertEqual(1, gerrit.stats['warned'])
 
-    @mock.patch('requests.auth.HTTPDigestAuth')
-    @mock.patch('requests.post')
-    def test_abandon(self, mock_post, mock_auth):
-        mock_auth_obj = mock.Mock()
-        mock_auth.return_value = mock_auth_obj
-        auto_abandon.abandon('123')
+    def test_abandon(self):
+        gerrit = self._get_gerrit()
+        self.assertTrue(auto_abandon.abandon(gerrit, '123'))
         data = {'message': auto_abandon.AB_MSG}
-        mock_auth.assert_called_with(USER, HTTP_PASSWORD)
-        mock_post.assert_called_with(
+        gerrit.session.post.assert_called_with(
             'https://review.openstack.org/a/changes/123/abandon',
             json=data,
-            auth=mock_auth_obj
+            timeout=30.0
             )
+        self.assertEqual(1, gerrit.stats['abandoned'])
 
-    @mock.patch('requests.auth.HTTPDigestAuth')
-    @mock.patch('requests.post')
-    def test_abandon_dryrun(self, mock_post, mock_auth):
+    def test_abandon_failed(self):
+        gerrit = self._get_gerrit()
+        gerrit.session.post.return_value.status_code = 409
+        self.assertFalse(auto_abandon.abandon(gerrit, '123'))
+        self.assertEqual(1, gerrit.session.post.call_count)
+        self.assertEqual(0, gerrit.stats['abandoned'])
+        self.assertEqual(1, gerrit.stats['failed'])
+
+    def test_abandon_dryrun(self):
         self.conf.config(dryrun=True)
-        mock_auth_obj = mock.Mock()
-        mock_auth.return_value = mock_auth_obj
-        auto_abandon.abandon('123')
-        self.assertFalse(mock_post.called)
-        self.assertFalse(mock_auth.called)
+        gerrit = self._get_gerrit()
+        self.assertFalse(auto_abandon.abandon(gerrit, '123'))
+        self.assertFalse(gerrit.session.post.called)
+        self.assertEqual(0, gerrit.stats['abandoned'])
+        self.assertEqual(1, gerrit.stats['would_abandon'])
 
     @mock.patch('tripleo_auto_abandon.auto_abandon.process_changes')
     @mock.patch('tripleo_auto_abandon.auto_abandon.get_changes')
+    def test_run(self, mock_get_changes, mock_process_changes):
+        gerrit = self._get_gerrit()
+        mock_get_changes.return_value = [mock.Mock(), mock.Mock()]
+        mock_index = mock.Mock()
+        auto_abandon.run(gerrit, mock_index)
+        mock_get_changes.assert_called_with(gerrit)
+        mock_process_changes.assert_called_with(
+            gerrit, mock_get_changes.return_value)
+        mock_index.update.assert_called_with(
+            'default', mock_process_changes.return_value)
+        self.assertEqual(2, gerrit.stats['changes'])
+
+    @mock.patch('tripleo_auto_abandon.auto_abandon.get_changes')
+    def test_run_abandoned_not_indexed(self, mock_get_changes):
+        stale = copy.deepcopy(FAKE_CHANGE)
+        stale['patchSets'][0]['approvals'] = [FAKE_MINUS_ONE]
+        fresh = copy.deepcopy(FAKE_CHANGE)
+        fresh['id'] = 'fresh-id'
+        fresh['number'] = '5678'
+        fresh['lastUpdated'] = int(time.time())
+        fresh['patchSets'][0]['approvals'] = [dict(FAKE_MINUS_ONE,
+                                                   grantedOn=int(time.time()))]
+        mock_get_changes.return_value = [stale, fresh]
+        gerrit = self._get_gerrit()
+        change_index = index.ChangeIndex(':memory:')
+        self.addCleanup(change_index.close)
+        # Indexed as open by a previous run
+        change_index.update('default', [index.change_record(stale)])
+
+        auto_abandon.run(gerrit, change_index)
+        self.assertEqual(1, gerrit.stats['abandoned'])
+        rows = change_index.near_abandonment(int(time.time()),
+                                             auto_abandon.ABANDON_DAYS,
+                                             auto_abandon.ABANDON_DAYS + 1)
+        self.assertEqual(['fresh-id'], [r['change_id'] for r in rows])
+
+    @mock.patch('tripleo_auto_abandon.auto_abandon.report_stats')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.run')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.load_gerrits')
     @mock.patch('tripleo_auto_abandon.auto_abandon.load_config')
-    def test_main(self, mock_load_config, mock_get_changes,
-                  mock_process_changes):
-        mock_get_changes.return_value = mock.Mock()
+    def test_main(self, mock_load_config, mock_load_gerrits, mock_run,
+                  mock_report_stats):
+        gerrits = [mock.Mock(), mock.Mock()]
+        mock_load_gerrits.return_value = gerrits
         auto_abandon.main()
         self.assertTrue(mock_load_config.called)
-        mock_process_changes.assert_called_with(mock_get_changes.return_value)
+        mock_run.assert_has_calls([mock.call(g, None) for g in gerrits],
+                                  any_order=True)
+        mock_report_stats.assert_has_calls([mock.call(g) for g in gerrits])
+
+    @mock.patch('tripleo_auto_abandon.auto_abandon.report_stats')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.run')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.load_gerrits')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.load_config')
+    def test_main_error(self, mock_load_config, mock_load_gerrits, mock_run,
+                        mock_report_stats):
+        gerrits = [mock.Mock(), mock.Mock()]
+        mock_load_gerrits.return_value = gerrits
+        mock_run.side_effect = [ValueError(), None]
+        self.assertRaises(ValueError, auto_abandon.main)
+        # Stats are still reported for every Gerrit
+        self.assertEqual(2, mock_report_stats.call_count)
+
+    @mock.patch('tripleo_auto_abandon.index.ChangeIndex')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.report_stats')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.run')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.load_gerrits')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.load_config')
+    def test_main_index(self, mock_load_config, mock_load_gerrits, mock_run,
+                        mock_report_stats, mock_index):
+        self.conf.config(index_file='/tmp/index.sqlite')
+        gerrit = mock.Mock()
+        mock_load_gerrits.return_value = [gerrit]
+        auto_abandon.main()
+        mock_index.assert_called_once_with('/tmp/index.sqlite')
+        mock_run.assert_called_once_with(gerrit, mock_index.return_value)
+        self.assertTrue(mock_index.return_value.close.called)
 
 
 FAKE_CHANGE = {
     'patchSets': [
         {'approvals': [],
-         'number': '1'}
+         'number': '1',
+         'revision': 'abc'}
     ],
     'status': 'NEW',
     'id': 'fake-id',
+    'number': '1234',
     'url': 'https://fake-url',
     'lastUpdated': 10,
     'commitMessage': 'Fake commit message',
@@ -151,11 +275,15 @@ FAKE_PASSED_CI = {
 
 
 class TestProcessChanges(base.TestCase):
+    def setUp(self):
+        super(TestProcessChanges, self).setUp()
+        self.gerrit = mock.Mock(max_concurrency=2)
+
     @mock.patch('reviewstats.utils.patch_set_approved')
     @mock.patch('reviewstats.utils.is_workinprogress')
     def test_wip(self, mock_is_wip, mock_psa):
         mock_is_wip.return_value = True
-        auto_abandon.process_changes([FAKE_CHANGE])
+        auto_abandon.process_changes(self.gerrit, [FAKE_CHANGE])
         # We should have bailed after the WIP check
         self.assertTrue(mock_is_wip.called)
         self.assertFalse(mock_psa.called)
@@ -167,64 +295,88 @@ class TestProcessChanges(base.TestCase):
         change['patchSets'] = [mock.MagicMock()]
         mock_is_wip.return_value = False
         mock_psa.return_value = True
-        auto_abandon.process_changes([change])
+        auto_abandon.process_changes(self.gerrit, [change])
         self.assertTrue(mock_is_wip.called)
         self.assertTrue(mock_psa.called)
         self.assertFalse(change['patchSets'][0].get.called)
 
-    @mock.patch(
-        'tripleo_auto_abandon.auto_abandon.days_since_negative_feedback')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.days_since')
     @mock.patch('reviewstats.utils.patch_set_approved')
     @mock.patch('reviewstats.utils.is_workinprogress')
     def test_no_approvals(self, mock_is_wip, mock_psa, mock_days):
         mock_is_wip.return_value = False
         mock_psa.return_value = False
-        auto_abandon.process_changes([FAKE_CHANGE])
+        auto_abandon.process_changes(self.gerrit, [FAKE_CHANGE])
         self.assertTrue(mock_is_wip.called)
         self.assertTrue(mock_psa.called)
         self.assertFalse(mock_days.called)
 
     @mock.patch('tripleo_auto_abandon.auto_abandon.abandon')
-    @mock.patch(
-        'tripleo_auto_abandon.auto_abandon.days_since_negative_feedback')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.days_since')
     def test_abandon_after_expiration(self, mock_days, mock_abandon):
         change = copy.deepcopy(FAKE_CHANGE)
         change['patchSets'][0]['approvals'] = [FAKE_MINUS_ONE]
         mock_days.return_value = auto_abandon.ABANDON_DAYS + 1
-        auto_abandon.process_changes([change])
-        mock_abandon.assert_called_once_with('fake-id')
+        auto_abandon.process_changes(self.gerrit, [change])
+        mock_abandon.assert_called_once_with(self.gerrit, 'fake-id')
 
     @mock.patch('tripleo_auto_abandon.auto_abandon.abandon')
-    @mock.patch(
-        'tripleo_auto_abandon.auto_abandon.days_since_negative_feedback')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.days_since')
     def test_not_abandon_less_than_expiration(self, mock_days, mock_abandon):
         change = copy.deepcopy(FAKE_CHANGE)
         change['patchSets'][0]['approvals'] = [FAKE_MINUS_ONE]
         mock_days.return_value = auto_abandon.ABANDON_DAYS
-        auto_abandon.process_changes([change])
+        auto_abandon.process_changes(self.gerrit, [change])
         self.assertFalse(mock_abandon.called)
 
-    @mock.patch(
-        'tripleo_auto_abandon.auto_abandon.days_since_negative_feedback')
+    @mock.patch('tripleo_auto_abandon.auto_abandon.abandon')
+    def test_records_abandoned(self, mock_abandon):
+        change = copy.deepcopy(FAKE_CHANGE)
+        change['patchSets'][0]['approvals'] = [FAKE_MINUS_ONE]
+        mock_abandon.return_value = True
+        self.assertEqual([],
+                         auto_abandon.process_changes(self.gerrit, [change]))
+        mock_abandon.return_value = False
+        records = auto_abandon.process_changes(self.gerrit, [change])
+        self.assertEqual(['fake-id'], [r['change_id'] for r in records])
+
+    @mock.patch('tripleo_auto_abandon.auto_abandon.abandon')
+    def test_records(self, mock_abandon):
+        mock_abandon.return_value = False
+        negative = copy.deepcopy(FAKE_CHANGE)
+        negative['patchSets'][0]['approvals'] = [FAKE_MINUS_ONE]
+        positive = copy.deepcopy(FAKE_CHANGE)
+        positive['id'] = 'positive-id'
+        positive['patchSets'][0]['approvals'] = [FAKE_PLUS_ONE]
+        records = auto_abandon.process_changes(self.gerrit,
+                                               [negative, positive])
+        self.assertEqual(['fake-id', 'positive-id'],
+                         [r['change_id'] for r in records])
+        self.assertEqual(BASE_TS, records[0]['negative_since'])
+        self.assertEqual('abc', records[0]['revision'])
+        self.assertIsNone(records[1]['negative_since'])
+
+    @mock.patch('tripleo_auto_abandon.auto_abandon.days_since')
     def test_ignore_restored(self, mock_days):
         change = copy.deepcopy(FAKE_CHANGE)
         change['lastUpdated'] = BASE_TS + 100
         change['patchSets'][0]['approvals'] = [FAKE_MINUS_ONE]
-        auto_abandon.process_changes([change])
+        records = auto_abandon.process_changes(self.gerrit, [change])
         self.assertFalse(mock_days.called)
+        self.assertIsNone(records[0]['negative_since'])
 
     def _test_multiple_patch_sets(self, mock_timegm, mock_abandon, good, bad,
                                   should_abandon):
         # 33 instead of 32 because the bad patch set happens after BASE_TS,
         # and due to rounding it ends up looking one full day newer.
         mock_timegm.return_value = BASE_TS + ONE_DAY * 33
-        good_patchset = {'approvals': [], 'number': good}
+        good_patchset = {'approvals': [], 'number': good, 'revision': good}
         good_patchset['lastUpdated'] = BASE_TS + 50 * (int(good) - 1)
         fake_pos = copy.deepcopy(FAKE_PLUS_ONE)
         fake_pos['grantedOn'] = good_patchset['lastUpdated']
         good_patchset['approvals'] = [fake_pos]
 
-        bad_patchset = {'approvals': [], 'number': bad}
+        bad_patchset = {'approvals': [], 'number': bad, 'revision': bad}
         bad_patchset['lastUpdated'] = BASE_TS + 50 * (int(bad) - 1)
         fake_neg = copy.deepcopy(FAKE_MINUS_ONE)
         fake_neg['grantedOn'] = bad_patchset['lastUpdated']
@@ -233,7 +385,7 @@ class TestProcessChanges(base.TestCase):
         patchsets = [bad_patchset, good_patchset]
         change = copy.deepcopy(FAKE_CHANGE)
         change['patchSets'] = patchsets
-        auto_abandon.process_changes([change])
+        auto_abandon.process_changes(self.gerrit, [change])
         self.assertEqual(should_abandon, mock_abandon.called)
 
     @mock.patch('tripleo_auto_abandon.auto_abandon.abandon')
@@ -328,3 +480,18 @@ class TestDaysCalculation(base.TestCase):
                          auto_abandon.days_since_negative_feedback(approvals,
                                                                    fake_ts))
 
+    def test_negative_feedback_timestamp(self):
+        fake_neg = copy.deepcopy(FAKE_MINUS_ONE)
+        fake_neg['grantedOn'] = BASE_TS + 10
+        approvals = [FAKE_FAILED_CI, fake_neg]
+        self.assertEqual(BASE_TS,
+                         auto_abandon.negative_feedback_timestamp(approvals))
+
+    def test_no_negative_feedback_timestamp(self):
+        self.assertIsNone(
+            auto_abandon.negative_feedback_timestamp([FAKE_PLUS_ONE]))
+
+    def test_days_since(self):
+        self.assertEqual(0, auto_abandon.days_since(None, BASE_TS))
+        self.assertEqual(2, auto_abandon.days_since(BASE_TS,
+                                                    BASE_TS + ONE_DAY * 2))